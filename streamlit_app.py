@@ -1,6 +1,206 @@
+import hashlib
+import io
 import streamlit as st
 import pandas as pd
-from collections import deque
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:  # Without Numba the kernels below still run, as plain Python over the same arrays
+    def njit(*args, **kwargs):
+        return lambda func: func
+
+
+# Uploaded data is only cached briefly and for a handful of runs, never kept indefinitely
+CACHE_ENTRIES = 4
+CACHE_TTL = "15m"
+
+
+@st.cache_data(show_spinner=False, max_entries=CACHE_ENTRIES, ttl=CACHE_TTL)
+def load_transactions(data: bytes, name: str) -> pd.DataFrame:
+    """Parse an uploaded CSV/Excel file. Cached on the raw bytes so reruns skip re-parsing."""
+    buf = io.BytesIO(data)
+    if name.endswith('.csv'):
+        df = pd.read_csv(buf)
+    else:
+        df = pd.read_excel(buf)
+    return df.dropna(how='all')  # Drop rows where all elements are NaN
+
+
+@st.cache_data(show_spinner=False, max_entries=CACHE_ENTRIES, ttl=CACHE_TTL, hash_funcs={pd.DataFrame: lambda _: None})
+def unique_values(df, file_hash, col, required_cols):
+    """List the distinct non-null values of ``col``, e.g. to offer as Buy/Sell choices.
+
+    The DataFrame itself is not hashed; ``file_hash`` and ``required_cols`` (which decide the rows
+    kept by the missing-value filter) key the cache instead.
+    """
+    return df[col].dropna().unique().tolist()
+
+
+def to_number(col: pd.Series) -> pd.Series:
+    """Convert a column to floats, accepting thousands separators. Unparseable cells become NaN."""
+    if pd.api.types.is_numeric_dtype(col):
+        return col.astype(float)
+    return pd.to_numeric(col.astype(str).str.replace(',', '', regex=False), errors='coerce').astype(float)
+
+
+@njit(cache=True)
+def fifo_match_group(start, end, k, is_buy, qtys, prices, open_qty, open_price, open_idx,
+                     sell_idx, buy_idx, used_qty, gain):
+    """Match rows ``start:end`` of a single group, writing its lots from output index ``k`` onwards.
+
+    A group never holds more open lots than it has rows, so its queue lives in its own
+    ``start:end`` slice of the shared queue arrays. Returns the output index after its last lot.
+    """
+    # Open lots queue up in the slice; head is the oldest lot, tail the next free slot
+    head = start
+    tail = start
+
+    for i in range(start, end):
+        if is_buy[i]:
+            open_qty[tail] = qtys[i]
+            open_price[tail] = prices[i]
+            open_idx[tail] = i
+            tail += 1
+            continue
+
+        sell_qty = qtys[i]
+        # Consume open lots oldest first; head advances (without branching) once a lot hits zero
+        while sell_qty > 0 and head < tail:
+            buy_qty = open_qty[head]
+            used = buy_qty if buy_qty < sell_qty else sell_qty
+            sell_idx[k] = i
+            buy_idx[k] = open_idx[head]
+            used_qty[k] = used
+            gain[k] = used * (prices[i] - open_price[head])
+            open_qty[head] = buy_qty - used
+            sell_qty -= used
+            head += open_qty[head] == 0.0
+            k += 1
+
+        # Whatever is left has no recorded purchase
+        if sell_qty > 0:
+            sell_idx[k] = i
+            buy_idx[k] = -1
+            used_qty[k] = sell_qty
+            gain[k] = np.nan
+            k += 1
+
+    return k
+
+
+@njit(cache=True)
+def fifo_match(bounds, is_buy, qtys, prices):
+    """Match each sell against the oldest open buys within its (identifier, currency) group.
+
+    Rows must be sorted so each group is one contiguous, date-ordered run; group ``g`` spans
+    rows ``bounds[g]:bounds[g + 1]``.
+
+    Returns parallel arrays with one entry per matched lot: the sell row, the buy row (-1 when
+    no open buy remains), the quantity used and the gain (NaN when unmatched). Every lot either
+    closes a buy or completes a sell, so ``len(qtys)`` bounds the number of lots.
+    """
+    n = qtys.shape[0]
+    num_groups = max(len(bounds) - 1, 0)
+
+    open_qty = np.empty(n, dtype=np.float64)
+    open_price = np.empty(n, dtype=np.float64)
+    open_idx = np.empty(n, dtype=np.int64)
+    sell_idx = np.empty(n, dtype=np.int64)
+    buy_idx = np.empty(n, dtype=np.int64)
+    used_qty = np.empty(n, dtype=np.float64)
+    gain = np.empty(n, dtype=np.float64)
+
+    k = 0
+    for g in range(num_groups):
+        k = fifo_match_group(bounds[g], bounds[g + 1], k, is_buy, qtys, prices,
+                             open_qty, open_price, open_idx, sell_idx, buy_idx, used_qty, gain)
+
+    return sell_idx[:k], buy_idx[:k], used_qty[:k], gain[:k]
+
+
+@st.cache_data(show_spinner=False, max_entries=CACHE_ENTRIES, ttl=CACHE_TTL, hash_funcs={pd.DataFrame: lambda _: None})
+def prepare_arrays(df, file_hash, date_col, type_col, qty_col, price_col, id_col, currency_col,
+                   extra_id_cols, input_date_format, buy_vals, sell_vals):
+    """Clean, filter and sort the transactions into the flat arrays the FIFO kernel consumes.
+
+    The DataFrame itself is not hashed; ``file_hash`` together with the column mapping keys the cache.
+    Returns ``(bounds, is_buy, qtys, prices, dates, identifiers, currencies, extras)``, one entry per
+    buy/sell row, with each (identifier, currency) group spanning ``bounds[g]:bounds[g + 1]``.
+    """
+    df = df.copy()
+    if input_date_format:
+        df[date_col] = pd.to_datetime(df[date_col], format=input_date_format, errors='coerce')
+    else:
+        df[date_col] = pd.to_datetime(df[date_col], errors='coerce')
+
+    df['Identifier'] = df[id_col]
+
+    if currency_col != '<None>':
+        df['Currency'] = df[currency_col]
+    else:
+        df['Currency'] = 'N/A'
+
+    # Clean numeric columns once up front and drop rows that could not be parsed
+    df['_qty'] = to_number(df[qty_col]).abs()
+    df['_price'] = to_number(df[price_col])
+    num_invalid = len(df)
+    df = df.dropna(subset=['_qty', '_price'])
+    num_invalid -= len(df)
+    if num_invalid:
+        st.warning(f"Skipped {num_invalid} row(s) with an invalid quantity or price.")
+
+    # Only buys and sells take part in matching; the kernel just needs a boolean buy flag per row
+    df['_is_buy'] = df[type_col].isin(buy_vals)
+    df = df[df['_is_buy'] | df[type_col].isin(sell_vals)]
+
+    # One stable multi-key sort lays each (identifier, currency) group out contiguously in date
+    # order; group bounds then follow from where either key changes between neighbouring rows
+    df = df.sort_values(['Identifier', 'Currency', date_col])
+    identifiers = df['Identifier'].to_numpy()
+    currencies = df['Currency'].to_numpy()
+    new_group = np.zeros(len(df), dtype=np.bool_)
+    new_group[1:] = (identifiers[1:] != identifiers[:-1]) | (currencies[1:] != currencies[:-1])
+    bounds = np.flatnonzero(np.diff(np.cumsum(new_group), prepend=-1, append=-1))
+
+    return (bounds, df['_is_buy'].to_numpy(), df['_qty'].to_numpy(), df['_price'].to_numpy(),
+            df[date_col].array, identifiers, currencies, df[list(extra_id_cols)].reset_index(drop=True))
+
+
+@st.cache_data(show_spinner=False, max_entries=CACHE_ENTRIES, ttl=CACHE_TTL, hash_funcs={pd.DataFrame: lambda _: None})
+def compute_fifo(df, file_hash, date_col, type_col, qty_col, price_col, id_col, currency_col,
+                 extra_id_cols, input_date_format, buy_vals, sell_vals):
+    """Match sells against earlier buys per (identifier, currency).
+
+    Returns a frame with one row per matched lot, the extra identification columns for those lots
+    and a boolean array marking the lots that found a recorded purchase; the others carry NaN/NaT
+    buy price, buy date and gain.
+
+    Takes the same arguments as ``prepare_arrays``. Rounding and date formatting are applied by the
+    caller so toggling them does not recompute lots.
+    """
+    bounds, is_buy, qtys, prices, dates, identifiers, currencies, extras = prepare_arrays(
+        df, file_hash, date_col, type_col, qty_col, price_col, id_col, currency_col,
+        extra_id_cols, input_date_format, buy_vals, sell_vals,
+    )
+
+    sell_idx, buy_idx, used_qty, gain = fifo_match(bounds, is_buy, qtys, prices)
+    matched = buy_idx >= 0
+
+    # Gather every output column straight from the kernel's lot arrays
+    lots = pd.DataFrame({
+        'Identifier': identifiers[sell_idx],
+        'Buy Date': dates.take(buy_idx, allow_fill=True),
+        'Buy Price': np.where(matched, prices[buy_idx], np.nan),
+        'Sell Date': dates.take(sell_idx),
+        'Sell Price': prices[sell_idx],
+        'Sell Qty': qtys[sell_idx],
+        'Used Qty': used_qty,
+        'Gain/Loss': gain,
+        'Currency': currencies[sell_idx],
+    })
+    return lots, extras.iloc[sell_idx].reset_index(drop=True), matched
+
 
 st.title("FIFO Transaction Gain/Loss Calculator")
 with st.sidebar:
@@ -44,11 +244,9 @@ uploaded_file = st.file_uploader("Upload your transaction history (CSV or Excel)
 if uploaded_file:
     # Load data
     try:
-        if uploaded_file.name.endswith('.csv'):
-            df = pd.read_csv(uploaded_file)
-        else:
-            df = pd.read_excel(uploaded_file)
-        df = df.dropna(how='all')  # Drop rows where all elements are NaN
+        file_bytes = uploaded_file.getvalue()
+        file_hash = hashlib.md5(file_bytes).hexdigest()
+        df = load_transactions(file_bytes, uploaded_file.name)
     except Exception as e:
         st.error(f"Failed to load file: {e}")
         st.stop()
@@ -76,14 +274,15 @@ if uploaded_file:
         required_cols.append(currency_col)
     required_cols += extra_id_cols
 
-    missing_rows = df[required_cols].isnull().any(axis=1)
-    num_missing = missing_rows.sum()
+    complete_rows = df[required_cols].notna().all(axis=1)
+    num_missing = len(df) - int(complete_rows.sum())
     if num_missing > 0:
         st.markdown(f"<span style='color:red'>Warning: {num_missing} row(s) have missing values in the selected columns and will be skipped.</span>", unsafe_allow_html=True)
-        df = df[~missing_rows]
+        df = df.loc[complete_rows]
 
-    # Rounding option
+    # Rounding and download options
     round_gains = st.checkbox("Round output Gain/Loss to 2 decimal places", True)
+    compress_download = st.checkbox("Compress the results download (.csv.gz)", False)
 
     # Date format options
     st.subheader("Date Format Options")
@@ -93,117 +292,54 @@ if uploaded_file:
     # Transaction values
     st.subheader("Define Buy and Sell values")
     try:
-        unique_values = df[type_col].dropna().unique().tolist()
+        type_values = unique_values(df, file_hash, type_col, tuple(required_cols))
     except Exception as e:
         st.error(f"Error accessing transaction type values: {e}")
         st.stop()
 
-    buy_vals = st.multiselect("Values representing a Buy", unique_values)
-    sell_vals = st.multiselect("Values representing a Sell", unique_values)
+    buy_vals = st.multiselect("Values representing a Buy", type_values)
+    sell_vals = st.multiselect("Values representing a Sell", type_values)
 
     if not buy_vals or not sell_vals:
         st.error("Please select at least one Buy and one Sell transaction type.")
         st.stop()
 
     if st.button("Run FIFO Calculation"):
+        has_currency = currency_col != '<None>'
         try:
-            if input_date_format:
-                df[date_col] = pd.to_datetime(df[date_col], format=input_date_format, errors='coerce')
-            else:
-                df[date_col] = pd.to_datetime(df[date_col], errors='coerce')
-
-            df = df.sort_values(by=date_col)
-            df['Identifier'] = df[id_col]
-            
-            has_currency = currency_col != '<None>'
-            if has_currency:
-                df['Currency'] = df[currency_col]
-            else:
-                df['Currency'] = 'N/A'
-
-            results = []
-
-            for (identifier, currency), group in df.groupby(['Identifier', 'Currency']):
-                fifo_queue = deque()
-                for _, row in group.iterrows():
-                    try:
-                        date = row[date_col]
-                        t_type = row[type_col]
-                        qty = abs(float(row[qty_col].replace(',', '') if isinstance(row[qty_col], str) else row[qty_col]))
-                        price = float(row[price_col].replace(',', '') if isinstance(row[price_col], str) else row[price_col])
-                    except Exception as e:
-                        st.warning(f"Skipping row due to invalid data: {e}")
-                        continue
-
-                    identifiers = {col: row[col] for col in extra_id_cols}
-
-                    if t_type in buy_vals:
-                        fifo_queue.append([qty, price, date])
-                    elif t_type in sell_vals:
-                        sell_qty = qty
-                        total_gain = 0
-                        lots = []
-
-                        while sell_qty > 0:
-                            if fifo_queue:
-                                buy_qty, buy_price, buy_date = fifo_queue[0]
-                                used_qty = min(sell_qty, buy_qty)
-                                gain = used_qty * (price - buy_price)
-                                if round_gains:
-                                    gain = round(gain, 2)
-                                total_gain += gain
-                                lots.append((used_qty, buy_price, buy_date, price, gain))
-
-                                if used_qty == buy_qty:
-                                    fifo_queue.popleft()
-                                else:
-                                    fifo_queue[0][0] -= used_qty
-                            else:
-                                used_qty = sell_qty
-                                gain = 'Unknown'
-                                lots.append((used_qty, 'Unknown', 'Unknown', price, gain))
-
-                            sell_qty -= used_qty
-
-                        results.append({
-                            'Date': date,
-                            'Identifier': identifier,
-                            'Currency': currency,
-                            'Sell Price': price,
-                            'Sell Qty': qty,
-                            'Gain/Loss': total_gain if isinstance(total_gain, (int, float)) else 'Unknown',
-                            'Matched Lots': lots,
-                            **identifiers
-                        })
+            results_df, extras_df, matched = compute_fifo(
+                df, file_hash, date_col, type_col, qty_col, price_col, id_col, currency_col,
+                tuple(extra_id_cols), input_date_format, tuple(buy_vals), tuple(sell_vals),
+            )
         except Exception as e:
             st.error(f"An error occurred during FIFO calculation: {e}")
             st.stop()
 
-        # Expand lots to show in output
-        expanded_results = []
-        for row in results:
-            for lot in row['Matched Lots']:
-                base = {
-                    'Identifier': row['Identifier'],
-                    'Buy Date': lot[2].strftime(output_date_format) if isinstance(lot[2], pd.Timestamp) else lot[2],
-                    'Buy Price': lot[1],
-                    'Sell Date': row['Date'].strftime(output_date_format) if pd.notnull(row['Date']) else 'Invalid Date',
-                    'Sell Price': row['Sell Price'],
-                    'Sell Qty': row['Sell Qty'],
-                    'Used Qty': lot[0],
-                    'Gain/Loss': lot[4]
-                }
-                if has_currency:
-                    base['Currency'] = row['Currency']
-                for col in extra_id_cols:
-                    base[col] = row.get(col, '')
-                expanded_results.append(base)
-
-        results_df = pd.DataFrame(expanded_results)
+        if not has_currency:
+            results_df = results_df.drop(columns='Currency')
+
+        # Round and format column-wise; lots with no recorded purchase show 'Unknown'
+        gains = results_df['Gain/Loss'].round(2) if round_gains else results_df['Gain/Loss']
+        results_df['Gain/Loss'] = gains.astype(object).where(matched, 'Unknown')
+        results_df['Buy Price'] = results_df['Buy Price'].astype(object).where(matched, 'Unknown')
+        results_df['Buy Date'] = results_df['Buy Date'].dt.strftime(output_date_format).where(matched, 'Unknown')
+        results_df['Sell Date'] = results_df['Sell Date'].dt.strftime(output_date_format).fillna('Invalid Date')
+
+        # Extra columns sharing an output column's name replace it in place, the rest are appended
+        clashing = results_df.columns.intersection(extras_df.columns)
+        for col in clashing:
+            results_df[col] = extras_df[col]
+        results_df = pd.concat([results_df, extras_df.drop(columns=clashing)], axis=1)
 
         # Show results
         st.subheader("FIFO Gain/Loss Results")
         st.dataframe(results_df)
 
-        csv = results_df.to_csv(index=False)
-        st.download_button("Download Results as CSV", csv, "fifo_results.csv", "text/csv")
+        # Write straight to bytes rather than building the whole CSV as a str first
+        buf = io.BytesIO()
+        if compress_download:
+            results_df.to_csv(buf, index=False, compression='gzip')
+            st.download_button("Download Results as CSV (gzip)", buf.getvalue(), "fifo_results.csv.gz", "application/gzip")
+        else:
+            results_df.to_csv(buf, index=False)
+            st.download_button("Download Results as CSV", buf.getvalue(), "fifo_results.csv", "text/csv")